@@ -9,10 +9,15 @@ import textwrap
 import os
 import openai
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 import logging
 from logger_config import get_logger
 from token_verifier import TokenVerifier
+from micro_batcher import MicroBatcher
+from openai_client import Hedger, create_openai_client, for_endpoint
+from artifact_store import ArtifactStore
+from quota_ledger import QuotaLedger, QuotaLedgerUnavailable
+from contextlib import asynccontextmanager
 
 # Hardcoded config vars are in config.py
 from config import *
@@ -21,7 +26,28 @@ from config import *
 logger = get_logger(logging.DEBUG)
 logger.info(f"Starting up rdancer's {__name__}")
 
-app = FastAPI()
+# The one OpenAI client shared by all requests; created at startup
+client = None
+# The token quotas, kept in memory and written behind to quota.db; drained on shutdown
+quota_ledger = None
+# The panels of every strip generated, so that it can be re-captioned without being regenerated
+artifact_store = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client, quota_ledger, artifact_store
+    client = create_openai_client()
+    quota_ledger = QuotaLedger()
+    artifact_store = ArtifactStore()
+    yield
+    artifact_store.close()
+    quota_ledger.close()
+    client.close()
+
+app = FastAPI(lifespan=lifespan)
+
+text_hedger = Hedger("text")
+embedding_hedger = Hedger("embeddings")
 
 # Set up CORS
 app.add_middleware(
@@ -52,6 +78,17 @@ class CompositeImage(BaseModel):
 class ImageResponse(BaseModel):
     images: List[ImageData]
     finalImage: CompositeImage
+    artifactId: Optional[str]
+
+class RecaptionRequest(BaseModel):
+    artifactId: str
+    captions: List[str]
+    title: str
+
+    token: str
+
+class RecaptionResponse(BaseModel):
+    finalImage: CompositeImage
 
 @app.get("/test")
 async def test_cors():
@@ -61,17 +98,23 @@ async def test_cors():
     headers = {"Access-Control-Allow-Origin": "*"}
     return JSONResponse(content=content, headers=headers)
 
+# Not async: the pipeline is made of blocking calls, so let FastAPI run it in its thread pool, where
+# many requests can be in flight at the same time (and have their embedding calls batched together)
 @app.post('/generate-images', response_model=ImageResponse)
-async def generate_images(request: ImageRequest):
+def generate_images(request: ImageRequest):
     token = request.token.strip()
     print(f"DEBUG: token: {token}, request: {request}")
     try:
-        verifier = TokenVerifier(token)
+        verifier = TokenVerifier(token, ledger=quota_ledger)
     except Exception as e:
         logger.error("Error processing token", exc_info=True)
         raise HTTPException(status_code=401, detail="Invalid token")
-    if not verifier.update_quota(1_000):
-        raise HTTPException(status_code=429, detail="Quota exceeded")
+    try:
+        if not verifier.update_quota(1_000):
+            raise HTTPException(status_code=429, detail="Quota exceeded")
+    except QuotaLedgerUnavailable:
+        logger.error("Quota accounting is unavailable", exc_info=True)
+        raise HTTPException(status_code=503, detail="Quota accounting is temporarily unavailable, please try again later")
     try:
         captions = [caption.strip() for caption in request.captions]
         title = request.title.strip()
@@ -85,23 +128,75 @@ async def generate_images(request: ImageRequest):
         # Throw away the autogenerated panel
         images = images[:-1]
 
-        # Compose the full strip
-        final_image = create_composite_image(images, captions, title)  # This should be an async function
-
         images_data = [ImageData(
             content_type='image/jpeg',
             base64=image_to_base64(image, 'JPEG'),
             original_prompt=caption,
         ) for caption, image in zip(captions, images)]
 
+        # Keep the panels, so that the strip can be re-captioned later; that's an extra, so if it
+        # fails, the strip (which has been paid for by now) is still returned
+        try:
+            artifact_id = store_panels(images)
+        except Exception as e:
+            logger.error("Failed to store the panels, the strip can't be re-captioned", exc_info=True)
+            artifact_id = None
+
+        # Compose the full strip
+        final_image = create_composite_image(images, captions, title)  # This should be an async function
+        del images
+
         final_image_data = CompositeImage(
             content_type='image/png',
             base64=image_to_base64(final_image, 'PNG'),
         )
+        del final_image
 
         return ImageResponse(
             images=images_data,
-            finalImage=final_image_data
+            finalImage=final_image_data,
+            artifactId=artifact_id,
+        )
+    except Exception as e:
+        logger.error("An error occured", exc_info=True)
+        raise e
+
+@app.post('/recaption', response_model=RecaptionResponse)
+def recaption(request: RecaptionRequest):
+    """
+    Re-render a previously generated strip with a new title and captions.
+
+    Only the composite image is redone, from the stored panels: there are no API calls, and so no quota is spent.
+    """
+    token = request.token.strip()
+    try:
+        TokenVerifier(token, ledger=quota_ledger)
+    except Exception as e:
+        logger.error("Error processing token", exc_info=True)
+        raise HTTPException(status_code=401, detail="Invalid token")
+    artifact_id = request.artifactId.strip()
+    try:
+        images = load_panels(artifact_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="No such artifact")
+    except OSError:
+        # The file is there, but it can't be read, or isn't an image
+        logger.error(f"Failed to load artifact {artifact_id}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Failed to load the stored panels")
+    captions = [caption.strip() for caption in request.captions]
+    if len(captions) != len(images):
+        raise HTTPException(status_code=400, detail=f"Expected {len(images)} captions")
+    title = request.title.strip()
+
+    try:
+        final_image = create_composite_image(images, captions, title)
+        del images
+
+        return RecaptionResponse(
+            finalImage=CompositeImage(
+                content_type='image/png',
+                base64=image_to_base64(final_image, 'PNG'),
+            )
         )
     except Exception as e:
         logger.error("An error occured", exc_info=True)
@@ -115,13 +210,8 @@ def create_fourth_panel_prompt(captions: list[str]) -> str:
     Create a prompt for the fourth panel based on the captions and title.
     """
 
-    global client
-    try:
-        client
-    except NameError:
-        client = openai.OpenAI()
-
-    completion = client.chat.completions.create(
+    completion = text_hedger.call(
+        for_endpoint(client, "text").chat.completions.create,
         model=TEXT_MODEL,
         messages=[
             {"role": "system", "content": "here are three picture descriptions. write a fourth description that is similar"},
@@ -141,34 +231,55 @@ def _generate_images(captions: list[str], title: str) -> tuple[list[Image], list
     @return tuple[list[Image], list[str]]: images, captions (including the autogenerated fourth panel caption)
 
     Generate individual images that hopefully have something to do with one anoher.
+
+    Each panel is cut out of the grid and scaled down in one go, and the full-size grid is let go of
+    before the slow vision and embedding calls, during which only the small panels are held.
     """
     assert len(captions) == 3
     amended_captions = captions + [create_fourth_panel_prompt(captions)]
     image_grid = generate_2x2_image_grid(amended_captions, title)
-    images = chop_up_2x2_image_grid(image_grid)
-    resized_images = [image.resize((400, 400), Image.Resampling.LANCZOS) for image in images]
+    resized_images = [resize_panel(image_grid, box) for box in panel_boxes(image_grid)]
+    del image_grid
     assert len(amended_captions) == 4
     return resized_images, amended_captions
 
-def chop_up_2x2_image_grid(image):
+def panel_boxes(image) -> list[tuple[int, int, int, int]]:
+    """
+    Given an image that is a 2x2 grid of panels, return the (left, upper, right, lower) boxes of the four panels.
     """
-    Given an image that is a 2x2 grid of panels, retun a list of the four indivial images.
-    """ 
     width, height = image.size
     panel_width = width // 2
     panel_height = height // 2
 
-    # Crop the image into four panels
-    panels = []
+    boxes = []
     for i in range(2):
         for j in range(2):
             left = j * panel_width
             upper = i * panel_height
             right = left + panel_width
             lower = upper + panel_height
-            panel = image.crop((left, upper, right, lower))
-            panels.append(panel)
-    return panels
+            boxes.append((left, upper, right, lower))
+    return boxes
+
+def resize_panel(image, box: tuple[int, int, int, int]) -> Image:
+    """
+    Cut the panel at box out of the grid, scaled down to PANEL_SIZE.
+
+    The panel is cropped before it is resized, so that the resampling doesn't pick up any pixels
+    from the neighbouring panels; the full-size crop is only around for the duration of the call.
+    """
+    return image.crop(box).resize(PANEL_SIZE, Image.Resampling.LANCZOS)
+
+def decode_base64_image(b64_data: str) -> Image:
+    """
+    Decode a base64-encoded image, and load it into PIL.
+
+    The raw bytes are released as soon as the pixel data has been read.
+    """
+    with io.BytesIO(base64.b64decode(b64_data)) as decoded_image:
+        image = Image.open(decoded_image)
+        image.load()
+    return image
 
 def generate_2x2_image_grid(captions: list[str], title: str) -> list[Image]:
     """
@@ -181,7 +292,7 @@ def generate_2x2_image_grid(captions: list[str], title: str) -> list[Image]:
         prompt += f"* {caption}\n"
     logger.debug(f"prompt: {prompt}")
     for retry in range(1, MAX_NUM_TRIES+1):
-        response = openai.images.generate(
+        response = for_endpoint(client, "images").images.generate(
             model="dall-e-3", # Defaults to v2 as of November 2023
             prompt=prompt,
             n=1,
@@ -189,13 +300,14 @@ def generate_2x2_image_grid(captions: list[str], title: str) -> list[Image]:
             response_format="b64_json"  # Requesting base64-encoded image
         )
 
-        # Extract and decode the base64-encoded image
-        first_image = response.data[0]
-        b64_data = first_image.b64_json
-        decoded_image = base64.b64decode(b64_data)
+        # Hang on to the revised prompt only, and let go of the (large) base64 payload
+        revised_prompt = response.data[0].revised_prompt
+        b64_data = response.data[0].b64_json
+        del response
 
-        # Load the image into PIL and return it
-        image = Image.open(io.BytesIO(decoded_image))
+        image = None  # Drop the rejected image from the previous try before decoding a new one
+        image = decode_base64_image(b64_data)
+        del b64_data
         if is_proper_grid(image, tolerance=10):
             logger.info(f"successfully generated image after {retry} {'try' if retry == 1 else 'tries'}")
             break
@@ -206,12 +318,8 @@ def generate_2x2_image_grid(captions: list[str], title: str) -> list[Image]:
         logger.error(s)
         # raise(s)
 
-    try:
-        revised_prompt = response[0].revised_prompt
-        if revised_prompt is not None and revised_prompt != prompt:
-            logger.debug(f"revised_prompt: {revised_prompt}")
-    except:
-        pass
+    if revised_prompt is not None and revised_prompt != prompt:
+        logger.debug(f"revised_prompt: {revised_prompt}")
 
     return image
 
@@ -224,15 +332,15 @@ def is_proper_grid(image: Image, tolerance: int) -> bool:
     import cv2
     import numpy as np
 
-    # Convert PIL Image to grayscale if not already
+    # Convert PIL Image to a grayscale NumPy array; the grayscale copy is not kept around
     if image.mode != 'L':
-        image = image.convert('L')
-
-    # Convert PIL Image to NumPy array
-    image_np = np.array(image)
+        image_np = np.asarray(image.convert('L'))
+    else:
+        image_np = np.asarray(image)
 
     # Apply Canny edge detection
     edges = cv2.Canny(image_np, 100, 200)
+    del image_np
 
     # Define divider line positions (for a 1024x1024 image)
     vertical_line = edges[:, 512]
@@ -260,7 +368,7 @@ def _analyze_images_with_vision_model(images: list[Image]) -> list[str]:
         # Convert image
         image = images[i]
         try:
-            response = client.chat.completions.create(
+            response = for_endpoint(client, "vision").chat.completions.create(
                 model=VISION_MODEL,
                 messages=[
                     {
@@ -352,8 +460,6 @@ def _rearrange_images(images: list[Image], captions: list[str], title: str) -> l
 
     Use OpenAI GPT-4 Vision
     """
-    global client
-
     # Step 1: Analyze images using the vision model
     observations = _analyze_images_with_vision_model(images)
     if observations.count("") > 1:
@@ -362,8 +468,9 @@ def _rearrange_images(images: list[Image], captions: list[str], title: str) -> l
 
     # Step 2: Generate embeddings for captions and observations
     try:
-        caption_embeddings = [embed_string(s) for s in captions]
-        observation_embeddings = [embed_string(s) for s in observations]
+        embeddings = embed_strings(captions + observations)
+        caption_embeddings = embeddings[:len(captions)]
+        observation_embeddings = embeddings[len(captions):]
     except Exception as e:
         logger.warn(f"Embedding failed, giving up on reordering: {e}")
         return images
@@ -377,20 +484,64 @@ def _rearrange_images(images: list[Image], captions: list[str], title: str) -> l
     # Step 5: Return reordered data
     return reordered_images
 
-def embed_string(s: str) -> list[float]:
+def _embed_batch(strings: list[str]) -> list[list[float]]:
     """
-    Simply generate the embedding vector
+    Generate the embedding vectors for a batch of strings, in one API call
     """
-    global client
-
-    s = s.replace("\n", " ").strip()
-    response = client.embeddings.create(
-        input=s,
+    response = embedding_hedger.call(
+        for_endpoint(client, "embeddings").embeddings.create,
+        input=strings,
         model=EMBEDDING_MODEL
     )
 
-    return response.data[0].embedding
+    return [data.embedding for data in sorted(response.data, key=lambda data: data.index)]
+
+# Embedding requests from all the pipelines in flight are collected, and sent off together
+embedding_batcher = MicroBatcher(
+    _embed_batch,
+    max_batch_size=EMBEDDING_BATCH_MAX_SIZE,
+    max_wait=EMBEDDING_BATCH_MAX_WAIT,
+    max_concurrent_batches=EMBEDDING_BATCH_MAX_CONCURRENT,
+    name="embedding-batcher",
+)
+
+def embed_strings(strings: list[str]) -> list[list[float]]:
+    """
+    Generate the embedding vectors, batched together with those of any concurrent requests
+    """
+    strings = [s.replace("\n", " ").strip() for s in strings]
+    # The API rejects the whole batch if any of the inputs is empty, so don't let one
+    # request's empty string fail everyone else's
+    if "" in strings:
+        raise ValueError("cannot embed an empty string")
+
+    return embedding_batcher.map(strings)
+
+
+def store_panels(images: list[Image]) -> str:
+    """
+    Store the panels side by side, as a single lossless image, and return its artifact id.
+    """
+    panel_width, panel_height = PANEL_SIZE
+    strip = Image.new('RGB', (panel_width * len(images), panel_height))
+    for i, image in enumerate(images):
+        strip.paste(image, (panel_width * i, 0))
+    with io.BytesIO() as buffered:
+        strip.save(buffered, format='PNG')
+        del strip
+        with buffered.getbuffer() as data:
+            return artifact_store.put(data)
+
+def load_panels(artifact_id: str) -> list[Image]:
+    """
+    Load the panels stored by store_panels().
 
+    @raise KeyError: if there is no such artifact
+    """
+    panel_width, panel_height = PANEL_SIZE
+    with io.BytesIO(artifact_store.get(artifact_id)) as buffered, Image.open(buffered) as strip:
+        strip.load()
+        return [strip.crop((panel_width * i, 0, panel_width * (i + 1), panel_height)) for i in range(strip.width // panel_width)]
 
 def draw_text(draw, text, position, font, container_width):
     """
@@ -413,8 +564,7 @@ def draw_text(draw, text, position, font, container_width):
     return y_offset - position[1]  # Return the height of the drawn text
 
 def create_composite_image(images, captions, title):
-    panel_width = 400
-    panel_height = 400
+    panel_width, panel_height = PANEL_SIZE
     gap = 10  # Gap between panels and above caption
     border = 3  # Border around each panel
     title_height = 24
@@ -467,10 +617,11 @@ def create_composite_image(images, captions, title):
     return final_image
 
 def image_to_base64(image, format):
-    buffered = io.BytesIO()
-    image.save(buffered, format=format)
-    image_bytes = buffered.getvalue()
-    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+    # Encode straight from the buffer, without copying the encoded image out of it first
+    with io.BytesIO() as buffered:
+        image.save(buffered, format=format)
+        with buffered.getbuffer() as image_bytes:
+            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
     return image_base64
 
 if __name__ == '__main__':
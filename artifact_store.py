@@ -0,0 +1,104 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from config import *
+
+logger = logging.getLogger("uvicorn")
+
+class ArtifactStore:
+    """
+    A content-addressed store of blobs on disk: a blob's id is the SHA-256 of its contents.
+
+    Storing the same contents twice is a no-op, and a stored blob never changes.
+
+    Blobs that have been neither stored nor read for max_age seconds are deleted; the store is
+    checked for them every prune_interval seconds.
+    """
+
+    ID_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+    def __init__(self, root: str = ARTIFACT_STORE_DIR, max_age: float = ARTIFACT_MAX_AGE, prune_interval: float = ARTIFACT_PRUNE_INTERVAL):
+        self.root = root
+        self.max_age = max_age
+        self.prune_interval = prune_interval
+        os.makedirs(self.root, exist_ok=True)
+
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._prune_periodically, name="artifact-store", daemon=True)
+        self._thread.start()
+
+    def path(self, artifact_id: str) -> str:
+        # The id ends up in a file path, so don't let anything but a proper hash through
+        if not self.ID_PATTERN.fullmatch(artifact_id):
+            raise KeyError(artifact_id)
+        return os.path.join(self.root, artifact_id[:2], artifact_id)
+
+    def put(self, data: bytes) -> str:
+        artifact_id = hashlib.sha256(data).hexdigest()
+        path = self.path(artifact_id)
+        try:
+            # Already there: just keep it from being pruned
+            os.utime(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file and rename it into place, so that a reader never sees half a blob
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except:
+                os.unlink(tmp_path)
+                raise
+        return artifact_id
+
+    def get(self, artifact_id: str) -> bytes:
+        path = self.path(artifact_id)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # A blob that is being used is kept for another max_age
+            os.utime(path)
+        except FileNotFoundError:
+            raise KeyError(artifact_id)
+        return data
+
+    def prune(self) -> int:
+        """
+        Delete the blobs (and any temporary files left behind) older than max_age, and return how many were deleted.
+        """
+        cutoff = time.time() - self.max_age
+        deleted = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.unlink(path)
+                        deleted += 1
+                except FileNotFoundError:
+                    pass
+        return deleted
+
+    def _prune_periodically(self) -> None:
+        while True:
+            try:
+                deleted = self.prune()
+                if deleted:
+                    logger.info(f"Pruned {deleted} artifacts older than {self.max_age}s")
+            except Exception:
+                logger.error("Failed to prune the artifact store", exc_info=True)
+            if self._closed.wait(self.prune_interval):
+                return
+
+    def close(self) -> None:
+        """
+        Stop the periodic pruning.
+        """
+        self._closed.set()
+        self._thread.join()
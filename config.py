@@ -1,4 +1,43 @@
 TEXT_MODEL = "gpt-4-1106-preview"
 VISION_MODEL = "gpt-4-vision-preview"
 LOGO_TEXT = "comix-generator.rdancer.org"
-EMBEDDING_MODEL = "text-embedding-ada-002"
\ No newline at end of file
+EMBEDDING_MODEL = "text-embedding-ada-002"
+PANEL_SIZE = (400, 400)
+
+# Embedding requests are batched across concurrent requests: a batch is sent once it has this many
+# inputs, or this many seconds after its first input arrived, and at most this many batches are in
+# flight at a time. Batching adds at most the max wait to a request's latency, plus, when all the
+# batches allowed are in flight, the wait for one of them to finish (the next batch grows meanwhile)
+EMBEDDING_BATCH_MAX_SIZE = 64
+EMBEDDING_BATCH_MAX_WAIT = 0.005
+EMBEDDING_BATCH_MAX_CONCURRENT = 4
+
+# The shared OpenAI client: connection pool, and per-endpoint timeouts (seconds) and retries
+OPENAI_MAX_CONNECTIONS = 100
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 20
+OPENAI_KEEPALIVE_EXPIRY = 60
+OPENAI_CONNECT_TIMEOUT = 5.0
+OPENAI_ENDPOINT_OPTIONS = {
+    "text": {"timeout": 30.0, "max_retries": 2},
+    "vision": {"timeout": 60.0, "max_retries": 2},
+    "embeddings": {"timeout": 10.0, "max_retries": 3},
+    # A generation takes most of a minute, and costs money every time, so don't retry too eagerly
+    "images": {"timeout": 120.0, "max_retries": 1},
+}
+
+# Send a duplicate of the short text and embedding requests if the first hasn't answered by the
+# p95 latency of recent requests (there is no hedging until there are enough requests for a p95)
+HEDGED_REQUESTS = True
+
+# Where the panels of generated strips are kept, for re-captioning
+ARTIFACT_STORE_DIR = "artifacts"
+# Stored panels are deleted once they have not been used for this many seconds (checked every prune interval)
+ARTIFACT_MAX_AGE = 7 * 24 * 60 * 60
+ARTIFACT_PRUNE_INTERVAL = 60 * 60
+
+# Quota debits are kept in memory and written to quota.db every this many seconds (and on shutdown);
+# this is also how much spending a crash can lose, as long as the writes succeed. Once this many
+# writes in a row have failed, new debits are refused until one succeeds, so a crash can never lose
+# more than (QUOTA_MAX_FAILED_FLUSHES + 1) * QUOTA_FLUSH_INTERVAL seconds' worth of spending
+QUOTA_FLUSH_INTERVAL = 1.0
+QUOTA_MAX_FAILED_FLUSHES = 3
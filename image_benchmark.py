@@ -0,0 +1,163 @@
+"""
+Benchmark the peak memory of the image path of a /generate-images request: as it used to be, and as it is now.
+
+The OpenAI calls are left out: a synthetic 1024x1024 grid stands in for the DALL-E payload, and the
+panels are encoded for the vision model, but not sent. Each variant runs in a fresh process, which
+reads the payload from a file. Reported are the growth of its peak RSS over the course of the run, and
+how much it holds on to while it would be waiting on the vision and embedding calls (which take
+seconds, so that is what limits how many requests fit in memory at once).
+"""
+import argparse
+import base64
+import ctypes
+import io
+import os
+import subprocess
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+from PIL import Image
+
+CAPTIONS = [
+    "A cat sits on a windowsill, looking at a bird outside",
+    "The cat jumps at the window, and bumps its head on the glass",
+    "The cat lies on the floor, dazed, with stars circling its head",
+    "The bird sits on the windowsill outside, looking at the cat",
+]
+TITLE = "The Window"
+
+def synthetic_payload() -> str:
+    """
+    A base64-encoded PNG of a noisy 1024x1024 grid, about as large as what DALL-E sends back.
+    """
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (1024, 1024, 3), dtype=np.uint8)
+    buffered = io.BytesIO()
+    Image.fromarray(pixels).save(buffered, format='PNG')
+    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+def vision_payload(image_base64: str) -> str:
+    return f"data:image/png;base64,{image_base64}"
+
+def old_image_to_base64(image, format):
+    buffered = io.BytesIO()
+    image.save(buffered, format=format)
+    image_bytes = buffered.getvalue()
+    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+    return image_base64
+
+def old_is_proper_grid(image, tolerance):
+    if image.mode != 'L':
+        image = image.convert('L')
+    image_np = np.array(image)
+    edges = cv2.Canny(image_np, 100, 200)
+    vertical_edges = np.sum(edges[:, 512] > 0)
+    horizontal_edges = np.sum(edges[512, :] > 0)
+    return vertical_edges <= tolerance and horizontal_edges <= tolerance
+
+def old_pipeline(payload: list[str], app, waiting) -> list[int]:
+    """
+    The image path as it was before the panels were cut out of the grid on demand.
+    """
+    def generate_images():
+        b64_data = payload.pop()
+        decoded_image = base64.b64decode(b64_data)
+        image = Image.open(io.BytesIO(decoded_image))
+        old_is_proper_grid(image, tolerance=10)
+        panels = [image.crop(box) for box in app.panel_boxes(image)]
+        return [panel.resize((400, 400), Image.Resampling.LANCZOS) for panel in panels]
+
+    images = generate_images()
+    waiting()
+    vision_sizes = [len(vision_payload(old_image_to_base64(image, 'PNG'))) for image in images]
+    images = images[:-1]
+    final_image = app.create_composite_image(images, CAPTIONS, TITLE)
+    [old_image_to_base64(image, 'JPEG') for image in images]
+    old_image_to_base64(final_image, 'PNG')
+    return vision_sizes
+
+def new_pipeline(payload: list[str], app, waiting) -> list[int]:
+    """
+    The image path as it is now, in app.generate_images().
+    """
+    def generate_images():
+        grid = app.decode_base64_image(payload.pop())
+        app.is_proper_grid(grid, tolerance=10)
+        return [app.resize_panel(grid, box) for box in app.panel_boxes(grid)]
+
+    images = generate_images()
+    waiting()
+    vision_sizes = [len(vision_payload(app.image_to_base64(image, 'PNG'))) for image in images]
+    images = images[:-1]
+    [app.image_to_base64(image, 'JPEG') for image in images]
+    app.store_panels(images)
+    final_image = app.create_composite_image(images, CAPTIONS, TITLE)
+    del images
+    app.image_to_base64(final_image, 'PNG')
+    return vision_sizes
+
+def rss_kb(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+
+def trimmed_rss_kb() -> int:
+    """
+    The RSS, once the allocator has handed back what has been freed, so that it is all live data (glibc only).
+    """
+    ctypes.CDLL("libc.so.6").malloc_trim(0)
+    return rss_kb("VmRSS")
+
+def reset_peak_rss() -> None:
+    """
+    Reset the peak RSS to the current RSS, so that whatever happened before doesn't mask the run (Linux only).
+    """
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+def run(variant: str, payload_path: str) -> None:
+    """
+    Run one variant on the payload in the file, and print the growth of the peak RSS and of the RSS
+    while waiting on the network (in KiB), and the mean vision payload size (in bytes).
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp())
+    import app
+    from artifact_store import ArtifactStore
+    app.artifact_store = ArtifactStore(os.path.join(os.getcwd(), "artifacts"))
+
+    # The payload is let go of during the run, so what is held while waiting is measured from before it was read
+    idle = trimmed_rss_kb()
+    with open(payload_path) as f:
+        payload = [f.read()]
+    reset_peak_rss()
+    baseline = rss_kb("VmRSS")
+    held = []
+    waiting = lambda: held.append(trimmed_rss_kb() - idle)
+    vision_sizes = (old_pipeline if variant == "old" else new_pipeline)(payload, app, waiting)
+    print(rss_kb("VmHWM") - baseline, held[0], sum(vision_sizes) // len(vision_sizes))
+
+def main():
+    # Made here, so that making it doesn't count towards the peak RSS of the variants
+    with tempfile.NamedTemporaryFile("w", suffix=".b64", delete=False) as f:
+        f.write(synthetic_payload())
+    results = {}
+    for variant in ["old", "new"]:
+        output = subprocess.run([sys.executable, __file__, "--variant", variant, "--payload", f.name], capture_output=True, text=True, check=True).stdout
+        results[variant] = [int(n) for n in output.split()[-3:]]
+    os.unlink(f.name)
+    for variant, (peak, held, vision_size) in results.items():
+        print(f"{variant}: peak RSS +{peak / 1024:>5.1f} MiB, while waiting +{held / 1024:>5.1f} MiB, vision payload {vision_size / 1024:>6.1f} KiB/panel")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the peak memory of the image path of a request.')
+    parser.add_argument('--variant', choices=["old", "new"], help='Run just this variant (used internally)')
+    parser.add_argument('--payload', help='The file with the payload to run the variant on (used internally)')
+    args = parser.parse_args()
+    if args.variant:
+        run(args.variant, args.payload)
+    else:
+        main()
@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger("uvicorn")
+
+class MicroBatcher:
+    """
+    Collect items submitted from any number of threads, and process them in batches.
+
+    A batch is sent off once max_batch_size items have been collected, or max_wait seconds after
+    the first item of the batch has arrived, whichever comes first. At most max_concurrent_batches
+    batches are processed at a time; while that many are in flight, items keep being collected, and
+    the next batch is sent (as large as it has grown, up to max_batch_size) as soon as one of them
+    is done. So batching adds at most max_wait to an item's latency, plus, under load, the wait for
+    a batch in flight to finish. Each caller gets back just the results for its own items, in order.
+
+    batch_fn takes a list of items, and must return a list of results of the same length and in
+    the same order. If it raises, every caller with an item in that batch gets the exception.
+    """
+
+    def __init__(self, batch_fn: Callable[[list], list], max_batch_size: int = 64, max_wait: float = 0.005, max_concurrent_batches: int = 4, name: str = "batcher"):
+        assert max_batch_size >= 1
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrent_batches = max_concurrent_batches
+        self.name = name
+
+        self._pending: list[tuple[Any, Future]] = []
+        self._first_arrival: Optional[float] = None
+        # The number of batches being processed
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        # Started lazily, on the first submit()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def submit(self, items: list) -> list[Future]:
+        """
+        Queue up the items, and return a future for each of them.
+        """
+        futures = [Future() for _ in items]
+        with self._condition:
+            self._start()
+            if not self._pending:
+                self._first_arrival = time.monotonic()
+            self._pending.extend(zip(items, futures))
+            self._condition.notify()
+        return futures
+
+    def map(self, items: list) -> list:
+        """
+        Process the items, blocking until all of them are done.
+        """
+        return [future.result() for future in self.submit(items)]
+
+    def _start(self) -> None:
+        if self._thread is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent_batches, thread_name_prefix=self.name)
+        self._thread = threading.Thread(target=self._collect, name=f"{self.name}-collector", daemon=True)
+        self._thread.start()
+
+    def _collect(self) -> None:
+        """
+        Wait for a batch to fill up (or for its time to run out), and for a worker to be free, and
+        hand the batch off to the executor.
+        """
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                while len(self._pending) < self.max_batch_size:
+                    remaining = self._first_arrival + self.max_wait - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                # Rather than queue the batch up behind the busy workers, let it grow in the meantime
+                while self._in_flight >= self.max_concurrent_batches:
+                    self._condition.wait()
+                self._in_flight += 1
+                batch = self._pending[:self.max_batch_size]
+                self._pending = self._pending[self.max_batch_size:]
+                # Whatever is left over has already waited long enough
+                self._first_arrival = time.monotonic() - self.max_wait if self._pending else None
+            self._executor.submit(self._process, batch)
+
+    def _process(self, batch: list[tuple[Any, Future]]) -> None:
+        items = [item for item, _ in batch]
+        logger.debug(f"{self.name}: processing a batch of {len(items)}")
+        try:
+            results = self.batch_fn(items)
+            if len(results) != len(items):
+                raise ValueError(f"{self.name}: got {len(results)} results for {len(items)} items")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify()
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
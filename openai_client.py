@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Optional, TypeVar
+
+import httpx
+import openai
+
+from config import *
+
+logger = logging.getLogger("uvicorn")
+
+T = TypeVar("T")
+
+def create_openai_client() -> openai.OpenAI:
+    """
+    Create the one OpenAI client the whole app shares, with a pool of keep-alive connections.
+
+    Use for_endpoint() to get a view of it with the timeouts and retries of a particular endpoint.
+    """
+    http_client = openai.DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+    )
+    return openai.OpenAI(http_client=http_client)
+
+def for_endpoint(client: openai.OpenAI, endpoint: str) -> openai.OpenAI:
+    """
+    Return a copy of the client with the timeout and retry policy of the endpoint (see OPENAI_ENDPOINT_OPTIONS).
+
+    The copy shares the connection pool with the original.
+    """
+    options = OPENAI_ENDPOINT_OPTIONS[endpoint]
+    return client.with_options(
+        timeout=httpx.Timeout(options["timeout"], connect=OPENAI_CONNECT_TIMEOUT),
+        max_retries=options["max_retries"],
+    )
+
+class Hedger:
+    """
+    Hedge calls: if a call hasn't returned by the time 95% of recent calls had, fire off a duplicate,
+    and take whichever answers first.
+
+    There is no hedging until there are min_samples calls to take the p95 from, and none while all
+    max_hedges duplicates are still out; so the duplicates can never hold up the calls themselves.
+    """
+
+    def __init__(self, name: str, window: int = 200, min_samples: int = 20, max_workers: int = 64, max_hedges: int = 8):
+        self.name = name
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-call")
+        # The duplicates get a pool of their own, and are only sent when there's a worker free for them
+        self._hedge_executor = ThreadPoolExecutor(max_workers=max_hedges, thread_name_prefix=f"{name}-hedge")
+        self._free_hedges = threading.BoundedSemaphore(max_hedges)
+
+    def delay(self) -> Optional[float]:
+        """
+        The p95 latency of recent calls, or None if there aren't enough of them yet.
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[int(len(latencies) * 0.95)]
+
+    def call(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        delay = self.delay()
+        if not HEDGED_REQUESTS or delay is None:
+            return self._timed(fn, *args, **kwargs)
+
+        started = threading.Event()
+
+        def primary():
+            started.set()
+            return self._timed(fn, *args, **kwargs)
+
+        futures = [self._executor.submit(primary)]
+        # Time spent waiting for a worker doesn't count: only a call that is itself slow gets hedged
+        started.wait()
+        done, _ = wait(futures, timeout=delay)
+        if not done and self._free_hedges.acquire(blocking=False):
+            logger.debug(f"{self.name}: no answer after {delay:.3f}s, sending a hedged request")
+            hedge = self._hedge_executor.submit(self._timed, fn, *args, **kwargs)
+            hedge.add_done_callback(lambda _: self._free_hedges.release())
+            futures.append(hedge)
+
+        # The first successful answer wins; the other call is left to finish in the background
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _timed(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        start = time.monotonic()
+        result = fn(*args, **kwargs)
+        with self._lock:
+            self._latencies.append(time.monotonic() - start)
+        return result
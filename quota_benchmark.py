@@ -0,0 +1,44 @@
+"""
+Benchmark the per-request cost of quota accounting: directly against quota.db, and through the QuotaLedger.
+
+Runs in a temporary directory, with a throwaway key pair and database.
+"""
+import argparse
+import os
+import tempfile
+import time
+import urllib.parse
+
+from token_generator import generate_rsa_key_pair, save_public_key_to_file, generate_token
+from token_verifier import TokenVerifier
+from quota_ledger import QuotaLedger
+
+def bench(verifier: TokenVerifier, requests: int) -> float:
+    """
+    Return the mean time, in seconds, of the quota accounting done for each /generate-images request.
+    """
+    start = time.perf_counter()
+    for _ in range(requests):
+        verifier.prepare_record(verifier.uuid, int(verifier.quota))
+        assert verifier.update_quota(1)
+    return (time.perf_counter() - start) / requests
+
+def main(requests: int):
+    os.chdir(tempfile.mkdtemp())
+    private_key = generate_rsa_key_pair()
+    save_public_key_to_file(private_key.public_key(), "public_key.pem")
+    token = urllib.parse.unquote(generate_token(requests * 10, private_key))
+
+    direct = bench(TokenVerifier(token), requests)
+    print(f"direct to SQLite: {direct * 1e6:>8.1f} µs/request")
+
+    ledger = QuotaLedger()
+    ledgered = bench(TokenVerifier(token, ledger=ledger), requests)
+    ledger.close()
+    print(f"quota ledger:     {ledgered * 1e6:>8.1f} µs/request")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the per-request cost of quota accounting.')
+    parser.add_argument('--requests', type=int, default=1_000, help='Number of requests to simulate (default: 1000)')
+    args = parser.parse_args()
+    main(args.requests)
@@ -0,0 +1,161 @@
+import logging
+import sqlite3
+import threading
+from typing import Union
+
+from config import *
+
+logger = logging.getLogger("uvicorn")
+
+class QuotaLedgerUnavailable(Exception):
+    """
+    Raised instead of taking a debit, while the ledger can't write to the database.
+    """
+
+class QuotaLedger:
+    """
+    Keep token quotas in memory, and write the debits behind to the SQLite database.
+
+    A UUID's balance is loaded from the database the first time it is seen. Checks and debits are
+    then served from memory, and the debits are written to the database in one transaction every
+    flush_interval seconds, and once more on close().
+
+    If the process dies, the debits of at most the last flush_interval seconds are lost (that is,
+    the quota spent in that window is given back). That holds for as long as the flushes succeed:
+    once max_failed_flushes of them in a row have failed, new debits are refused (with
+    QuotaLedgerUnavailable) until a flush goes through again, so that no more than
+    (max_failed_flushes + 1) * flush_interval seconds' worth of debits are ever at risk.
+
+    The database is only ever written by deltas, but the in-memory balances assume that this process
+    is the only one spending quota.
+    """
+
+    def __init__(self, db_path: str = 'quota.db', flush_interval: float = QUOTA_FLUSH_INTERVAL, max_failed_flushes: int = QUOTA_MAX_FAILED_FLUSHES):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.max_failed_flushes = max_failed_flushes
+
+        self._lock = threading.Lock()
+        self._balances: dict[str, int] = {}
+        # Records that are not in the database yet: uuid -> initial quota
+        self._new_records: dict[str, int] = {}
+        # Debits that are not in the database yet: uuid -> tokens spent
+        self._debits: dict[str, int] = {}
+        # The number of flushes in a row that have failed
+        self._failed_flushes = 0
+
+        # Serialises flushes, so that a batch is never written twice
+        self._flush_lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS quotas
+                              (uuid TEXT PRIMARY KEY, quota INTEGER)''')
+        self._conn.commit()
+        # Balances are read on a connection of their own, so that they don't queue up behind a flush
+        self._read_lock = threading.Lock()
+        self._read_conn = sqlite3.connect(self.db_path, check_same_thread=False)
+
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._flush_periodically, name="quota-ledger", daemon=True)
+        self._thread.start()
+
+    def _load(self, uuid: str) -> None:
+        """
+        Make sure the balance of the uuid is in memory; must be called without self._lock held.
+
+        The database is read outside of the lock, so that a UUID seen for the first time doesn't hold
+        up the checks and debits of all the others.
+        """
+        with self._lock:
+            if uuid in self._balances:
+                return
+        with self._read_lock:
+            row = self._read_conn.execute("SELECT quota FROM quotas WHERE uuid = ?", (uuid,)).fetchone()
+        if row:
+            with self._lock:
+                # Another thread may have loaded it (and started spending it) in the meantime
+                self._balances.setdefault(uuid, row[0])
+
+    def prepare_record(self, uuid: str, quota: int) -> None:
+        self._load(uuid)
+        with self._lock:
+            if uuid not in self._balances:
+                self._balances[uuid] = quota
+                self._new_records[uuid] = quota
+
+    def _remaining(self, uuid: str, token_count: int) -> Union[int, None]:
+        """
+        Must be called with self._lock held, after _load().
+        """
+        balance = self._balances.get(uuid)
+        if balance is not None and balance >= token_count:
+            return balance - token_count
+        return None
+
+    def quota_remaining(self, uuid: str, token_count: int = 1) -> Union[int, None]:
+        self._load(uuid)
+        with self._lock:
+            return self._remaining(uuid, token_count)
+
+    def update_quota(self, uuid: str, spent_tokens: int) -> bool:
+        self._load(uuid)
+        # The check and the debit have to happen atomically, or two requests could both spend the last of a quota
+        with self._lock:
+            if self._failed_flushes >= self.max_failed_flushes:
+                raise QuotaLedgerUnavailable(f"the last {self._failed_flushes} flushes to {self.db_path} have failed")
+            remaining = self._remaining(uuid, spent_tokens)
+            # Same as TokenVerifier.update_quota(): a debit that would leave nothing is refused
+            if not remaining:
+                return False
+            self._balances[uuid] = remaining
+            self._debits[uuid] = self._debits.get(uuid, 0) + spent_tokens
+        return True
+
+    def flush(self) -> None:
+        """
+        Write all the pending records and debits to the database, in a single transaction.
+        """
+        with self._flush_lock:
+            with self._lock:
+                new_records, self._new_records = self._new_records, {}
+                debits, self._debits = self._debits, {}
+            if not new_records and not debits:
+                return
+            try:
+                with self._conn:
+                    self._conn.executemany("INSERT OR IGNORE INTO quotas (uuid, quota) VALUES (?, ?)", new_records.items())
+                    self._conn.executemany("UPDATE quotas SET quota = quota - ? WHERE uuid = ?", [(spent, uuid) for uuid, spent in debits.items()])
+            except Exception:
+                # Put the batch back, to be retried on the next flush
+                with self._lock:
+                    self._failed_flushes += 1
+                    for uuid, quota in new_records.items():
+                        self._new_records.setdefault(uuid, quota)
+                    for uuid, spent in debits.items():
+                        self._debits[uuid] = self._debits.get(uuid, 0) + spent
+                raise
+            with self._lock:
+                self._failed_flushes = 0
+        logger.debug(f"Flushed {len(new_records)} new quota records and {len(debits)} debits")
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.error("Failed to flush the quota ledger", exc_info=True)
+
+    def close(self) -> None:
+        """
+        Stop the periodic flushing, and drain whatever is still pending.
+        """
+        self._closed.set()
+        self._thread.join()
+        try:
+            self.flush()
+        except Exception:
+            with self._lock:
+                lost = sum(self._debits.values())
+            logger.error(f"Failed to drain the quota ledger, {lost} tokens of spending are lost", exc_info=True)
+        finally:
+            self._conn.close()
+            self._read_conn.close()
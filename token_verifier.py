@@ -7,11 +7,18 @@ from base64 import urlsafe_b64decode
 import sys
 from typing import Union, Optional
 import argparse
+from quota_ledger import QuotaLedger
 
 class TokenVerifier:
-    def __init__(self, url_fragment: str):
+    def __init__(self, url_fragment: str, ledger: Optional[QuotaLedger] = None):
+        """
+        If a ledger is given, the quota is kept there (in memory); otherwise it is read from and
+        written to the database directly.
+        """
         self.db_path = 'quota.db'
-        self.initialize_database()
+        self.ledger = ledger
+        if self.ledger is None:
+            self.initialize_database()
         
         # Extract and verify token from URL
         token = self.extract_token(url_fragment)
@@ -70,6 +77,8 @@ class TokenVerifier:
         conn.close()
     
     def prepare_record(self, uuid: str, quota: int):
+        if self.ledger is not None:
+            return self.ledger.prepare_record(uuid, quota)
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         cursor.execute("INSERT OR IGNORE INTO quotas (uuid, quota) VALUES (?, ?)", (uuid, quota))
@@ -77,6 +86,8 @@ class TokenVerifier:
         conn.close()
     
     def quota_remaining(self, token_count: int = 1) -> Union[int, None]:
+        if self.ledger is not None:
+            return self.ledger.quota_remaining(self.uuid, token_count)
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         cursor.execute("SELECT quota FROM quotas WHERE uuid = ?", (self.uuid,))
@@ -86,6 +97,8 @@ class TokenVerifier:
         return None
     
     def update_quota(self, spent_tokens: int) -> bool:
+        if self.ledger is not None:
+            return self.ledger.update_quota(self.uuid, spent_tokens)
         if not self.quota_remaining(spent_tokens):
             return False
         